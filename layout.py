@@ -0,0 +1,85 @@
+# Copyright (c) 2013 by R. David Murray under an MIT license (LICENSE.txt).
+from urllib.parse import urlencode
+from util import Template
+
+# The layout functions other than page() yield lines of html without line
+# endings.  page() assembles them into the complete response body: the static
+# page markup is pre-encoded in _page, and the dynamic parts are joined into a
+# single string and encoded once, instead of once per line.
+
+CRLF = '\r\n'
+
+_page = Template(CRLF.join([
+    '<html>',
+    '<head>',
+    '  <title>',
+    '    Feedme: {}',
+    '  </title>',
+    '  <meta name="viewport" content="width=device-width">',
+    '  <script language="JavaScript" src="/static/swipesense.js"></script>',
+    '</head>',
+    '<body bgcolor="#000000" text="#FFFFFF" link="#FFFFFF" vlink="#FFFFFF"',
+    '      id="body" ontouchstart="touchStart(event, \'body\');"',
+    '                ontouchend="touchEnd(event);"',
+    '                ontouchmove="touchMove(event);"',
+    '                ontouchcancel="touchCancel(event);">',
+    '  <h1 style="max-width: 8in">{}</h1>',
+    '  <table>',
+    # The content rows each end with a CRLF.
+    '{}  </table>',
+    '</body>',
+    '</html>',
+    '',
+    ]))
+
+_content_start = '    <tr><td>' + CRLF
+_content_end = '    </td></tr>' + CRLF
+
+def _content_rows(content):
+    for part in content:
+        yield _content_start
+        for line in part:
+            yield '      '
+            yield line
+            yield CRLF
+        yield _content_end
+
+def page(title, content, h1=None):
+    """Return the utf-8 encoded html page holding the parts in content.
+
+    Each part of content is an iterable of lines, and becomes one row of the
+    page's layout table.
+    """
+    if h1 is None:
+        h1 = title
+    return _page.render(title, h1, ''.join(_content_rows(content)))
+
+def table(titlerow, content_rows):
+    yield '<table border=1>'
+    yield '  <tr>'
+    for title in titlerow:
+        yield '    <th style="max-width: 8in">{}</th>'.format(title)
+    yield '  </tr>'
+    for row in content_rows:
+        yield '  <tr>'
+        for item in row:
+            yield '    <td style="max-width: 8in">{}</td>'.format(item)
+        yield '  </tr>'
+    yield '</table>'
+
+def linktable(*links):
+    yield '<table width="100%">'
+    yield '  <tr>'
+    yield '    <td align="left">{}</td>'.format(links[0])
+    for link in links[1:-1]:
+        yield '    <td align="center">{}</td>'.format(link)
+    if len(links) > 1:
+        yield '    <td align="right">{}</td>'.format(links[-1])
+    yield '  </tr>'
+    yield '</table>'
+
+def link(text, url, settings=None, style=None):
+    style = ' style="{}" '.format(style) if style else ' '
+    if settings:
+        url = url + '?' + urlencode(settings)
+    return '<a{}href="{}">{}</a>'.format(style, url, text)
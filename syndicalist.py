@@ -1,8 +1,19 @@
 # Copyright (c) 2013 by R. David Murray under an MIT license (LICENSE.txt).
 import os
+import re
 import sys
+import gzip
+import zlib
+import json
+import time
 import argparse
+import operator
+import threading
 import functools
+import itertools
+import shutil
+import hashlib
+import urllib.request
 import feedparser
 from datetime import datetime
 from dinsd import rel, row, ns
@@ -12,6 +23,9 @@ from dinsd.sqlite_pickle_db import Database
 class FeedmeError(Exception):
     pass
 
+# Maximum number of articles handled at once by bulk operations.
+BATCH_SIZE = 500
+
 #
 # Helpers
 #
@@ -19,8 +33,15 @@ class FeedmeError(Exception):
 def new_articles(feedid, feedblob):
     new = rel(db.r.articles.header)()
     with ns(fid=feedid):
-        ids = db.r.articles.where('feedid == fid').compute('seqno')
-    nextid = functools.reduce(max, ids, next(ids, 0)) + 1
+        if db.r.importing.where('feedid == fid'):
+            # Our seqnos would collide with the ones still to be imported.
+            raise FeedmeError("Feed {} is partially imported, run the "
+                              "import again to finish it".format(feedid))
+        if not db.r.readstate.where('feedid == fid'):
+            db.r.readstate.insert(~row(feedid=feedid, lastseqno=0,
+                                       highwater=0))
+    state = _readstate(feedid)
+    first = nextid = state.lastseqno + 1
     for a in reversed(feedblob.entries):
         with ns(a=a):
             if db.r.articles.where('guid == a.id'):
@@ -36,18 +57,531 @@ def new_articles(feedid, feedblob):
                               title=a.title,
                               link=a.link,
                               data=a,
-                              pubdate=pubdate,
-                              read=False)
+                              pubdate=pubdate)
             db.r.articles.insert(~new_article)
             new = new | ~new_article
             nextid += 1
+    with ns(fid=feedid, last=nextid-1):
+        db.r.readstate.update('feedid == fid', lastseqno='last')
+    _log_articles(feedid, first, nextid-1)
     print(feedblob.feed.get('title', '**Unknown Title**'))
     print(new >> {'title', 'pubdate'})
 
+def delete_feed(feedid):
+    with ns(todel=feedid):
+        db.r.articles.delete("feedid == todel")
+        db.r.readstate.delete("feedid == todel")
+        db.r.readflips.delete("feedid == todel")
+        db.r.pollstats.delete("feedid == todel")
+        db.r.importing.delete("feedid == todel")
+        db.r.feedlist.delete("id == todel")
+    _log_deletion(feedid)
+
+#
+# Polling
+#
+# Many feeds don't support ETag/Last-Modified but serve the same bytes for
+# hours, so we fetch the raw body ourselves and only parse it if its digest
+# differs from the one recorded by the last successful poll.  Elements that
+# change on every request without the feed content changing are dropped
+# before computing the digest.  pollstats also records how often the digest
+# check let us skip the parse.
+#
+
+# Feed level elements whose content changes on every request: RSS
+# lastBuildDate and the Atom feed's updated.  Only the part of the body before
+# the first item or entry is normalized, so that changes to the updated
+# timestamps of the entries themselves still count.
+_churn_elements = (b'lastBuildDate', b'updated')
+_churn_re = re.compile(rb'<((?:\w+:)?(?:' + b'|'.join(_churn_elements) +
+                       rb'))\b[^>]*>[^<]*</\1\s*>\s*')
+_first_item_re = re.compile(rb'<(?:\w+:)?(?:item|entry)\b')
+
+USER_AGENT = 'syndicalist/0.1 +https://github.com/bitdancer/syndicalist'
+FETCH_TIMEOUT = 60
+
+def _init_pollstats():
+    db['pollstats'] = rel(feedid=int, digest=str, polls=int, unchanged=int)
+    db.set_key('pollstats', {'feedid'})
+
+def feed_digest(body):
+    """Return a digest of body that ignores timestamp-only changes."""
+    first_item = _first_item_re.search(body)
+    split = first_item.start() if first_item else len(body)
+    head = _churn_re.sub(b'', body[:split])
+    return hashlib.sha1(head + body[split:]).hexdigest()
+
+def fetch_feed(url):
+    """Return the body of the feed at url, its headers, and its digest.
+
+    As with feedparser.parse, url may also be the path to a local file.
+    """
+    if os.path.exists(url):
+        with open(url, 'rb') as f:
+            body = f.read()
+        return body, {}, feed_digest(body)
+    request = urllib.request.Request(url, headers={
+        'User-Agent': USER_AGENT,
+        'Accept-Encoding': 'gzip, deflate',
+        })
+    with urllib.request.urlopen(request, timeout=FETCH_TIMEOUT) as resp:
+        body = resp.read()
+        headers = {k.lower(): v for k, v in resp.headers.items()}
+        # Allows feedparser to resolve relative links.
+        headers.setdefault('content-location', resp.geturl())
+    # We hand feedparser the decoded body, so it must not decode it again.
+    encoding = headers.pop('content-encoding', '')
+    headers.pop('content-length', None)
+    if encoding == 'gzip':
+        body = gzip.decompress(body)
+    elif encoding == 'deflate':
+        try:
+            body = zlib.decompress(body)
+        except zlib.error:
+            # Some servers send a raw deflate stream without the zlib header.
+            body = zlib.decompress(body, -zlib.MAX_WBITS)
+    return body, headers, feed_digest(body)
+
+def _record_poll(feedid, digest, unchanged):
+    with ns(fid=feedid):
+        if not db.r.pollstats.where('feedid == fid'):
+            db.r.pollstats.insert(~row(feedid=feedid, digest='',
+                                       polls=0, unchanged=0))
+    with ns(fid=feedid, newdigest=digest, hit=int(unchanged)):
+        db.r.pollstats.update('feedid == fid',
+                              digest='newdigest',
+                              polls='polls + 1',
+                              unchanged='unchanged + hit')
+
+def update_feed(feedid, url):
+    """Add any new articles in the feed at url to feed feedid.
+
+    Return False without parsing the feed if its content is unchanged since
+    the last poll, True otherwise.
+    """
+    body, headers, digest = fetch_feed(url)
+    with ns(fid=feedid, newdigest=digest):
+        unchanged = bool(db.r.pollstats.where(
+            'feedid == fid and digest == newdigest'))
+    if not unchanged:
+        new_articles(feedid, feedparser.parse(body, response_headers=headers))
+    _record_poll(feedid, digest, unchanged)
+    return not unchanged
+
+#
+# Read state
+#
+# Read state is kept per feed rather than in the (large) article rows.  Every
+# article whose seqno is at or below the feed's highwater mark is read, and
+# every article above it is unread, except for the seqnos listed for the feed
+# in readflips, whose state is the opposite.  lastseqno is the seqno of the
+# newest article in the feed; seqnos are assigned consecutively from 1.
+#
+
+def _init_readstate():
+    db['readstate'] = rel(feedid=int, lastseqno=int, highwater=int)
+    db.set_key('readstate', {'feedid'})
+    db['readflips'] = rel(feedid=int, seqno=int)
+    db.set_key('readflips', {'feedid', 'seqno'})
+
+def _readstate(feedid):
+    with ns(fid=feedid):
+        state = db.r.readstate.where('feedid == fid')
+    # A feed has no row until new_articles has been run for it, which might
+    # not have happened (the first parse failed, an import was interrupted).
+    return ~state if state else row(feedid=feedid, lastseqno=0, highwater=0)
+
+def _readflips(feedid):
+    with ns(fid=feedid):
+        return set(db.r.readflips.where('feedid == fid').compute('seqno'))
+
+def is_read(feedid, seqno):
+    state = _readstate(feedid)
+    with ns(fid=feedid, sno=seqno):
+        flipped = db.r.readflips.where('feedid == fid and seqno == sno')
+    return (seqno <= state.highwater) != bool(flipped)
+
+def unread_seqnos(feedid):
+    """Return the set of seqnos of the unread articles in feed feedid."""
+    state = _readstate(feedid)
+    unread = set(range(state.highwater + 1, state.lastseqno + 1))
+    # Flips above the highwater mark are read, flips at or below it unread.
+    return unread ^ _readflips(feedid)
+
+def unread_count(feedid):
+    state = _readstate(feedid)
+    flips = _readflips(feedid)
+    flipped_read = sum(1 for seqno in flips if seqno > state.highwater)
+    return (state.lastseqno - state.highwater
+            - flipped_read + (len(flips) - flipped_read))
+
+def set_read(feedid, seqno, read):
+    state = _readstate(feedid)
+    flip = (seqno <= state.highwater) != read
+    with ns(fid=feedid, sno=seqno):
+        flipped = db.r.readflips.where('feedid == fid and seqno == sno')
+        if flip and not flipped:
+            db.r.readflips.insert(~row(feedid=feedid, seqno=seqno))
+        elif flipped and not flip:
+            db.r.readflips.delete('feedid == fid and seqno == sno')
+        else:
+            return
+    _log_read(feedid, seqno, seqno, read)
+    if read and seqno == state.highwater + 1:
+        # Absorb the run of read articles now adjoining the highwater mark.
+        flips = _readflips(feedid)
+        highwater = seqno
+        while highwater + 1 in flips:
+            highwater += 1
+        with ns(fid=feedid, old=state.highwater, new=highwater):
+            db.r.readflips.delete('feedid == fid and seqno > old '
+                                  'and seqno <= new')
+            db.r.readstate.update('feedid == fid', highwater='new')
+
+def mark_feed_read(feedid):
+    with ns(fid=feedid):
+        db.r.readstate.update('feedid == fid', highwater='lastseqno')
+        db.r.readflips.delete('feedid == fid')
+    _log_read(feedid, 1, _readstate(feedid).lastseqno, True)
+
+#
+# Change log
+#
+# Sync clients ask for the changes made since the last value of the change
+# counter they saw.  Every change to the articles or read state bumps the
+# counter, and is logged under the new value as a range of seqnos:
+# articlechanges records articles added to a feed, readchanges articles set
+# read or unread.  Additions are logged in chunks of at most BATCH_SIZE
+# articles, so that a client can be sent a bounded number of articles at a
+# time without splitting a change.  Deleting a feed drops its log entries and
+# logs the deletion in feeddeletions, since the feed id may be reused.
+#
+# Logging a read state change drops the feed's earlier readchanges rows whose
+# range it covers, so superseded changes are not sent again (marking a feed
+# read leaves just the one row).  A client that missed a dropped row gets the
+# row that superseded it.
+#
+# The web UI logs changes from both the server thread and the update thread,
+# so bumping the counter and logging the change under it, and reading the
+# log, are done holding _changelog_lock.  Otherwise a reader could see a
+# counter value before the change logged under it, or two changes could get
+# the same version.
+#
+
+_changelog_lock = threading.RLock()
+
+def _init_changelog():
+    db['changecounter'] = rel(counter=int)
+    db.r.changecounter.insert(~row(counter=0))
+    db['articlechanges'] = rel(version=int, feedid=int, first=int, last=int)
+    db.set_key('articlechanges', {'version'})
+    db['readchanges'] = rel(version=int, feedid=int, first=int, last=int,
+                            read=bool)
+    db.set_key('readchanges', {'version', 'first'})
+    _init_feeddeletions()
+
+def _init_feeddeletions():
+    db['feeddeletions'] = rel(version=int, feedid=int)
+    db.set_key('feeddeletions', {'version'})
+
+def change_counter():
+    return (~db.r.changecounter).counter
+
+def _bump_counter():
+    # Callers must hold _changelog_lock.
+    db.r.changecounter.update('True', counter='counter + 1')
+    return change_counter()
+
+def _log_articles(feedid, first, last):
+    with _changelog_lock:
+        for start in range(first, last + 1, BATCH_SIZE):
+            db.r.articlechanges.insert(~row(version=_bump_counter(),
+                                            feedid=feedid,
+                                            first=start,
+                                            last=min(start+BATCH_SIZE-1,
+                                                     last)))
+
+def _log_read(feedid, first, last, read):
+    if last < first:
+        return
+    with _changelog_lock:
+        with ns(fid=feedid, newfirst=first, newlast=last):
+            db.r.readchanges.delete('feedid == fid and first >= newfirst '
+                                    'and last <= newlast')
+        db.r.readchanges.insert(~row(version=_bump_counter(),
+                                     feedid=feedid,
+                                     first=first,
+                                     last=last,
+                                     read=read))
+
+def _log_feed(feedid, lastseqno, highwater, flips):
+    """Log the complete current state of a feed that has no log entries."""
+    runs = []
+    start = None
+    for seqno in range(1, lastseqno + 2):
+        read = seqno <= lastseqno and (seqno <= highwater) != (seqno in flips)
+        if read and start is None:
+            start = seqno
+        elif not read and start is not None:
+            runs.append((start, seqno - 1))
+            start = None
+    with _changelog_lock:
+        _log_articles(feedid, 1, lastseqno)
+        if runs:
+            version = _bump_counter()
+            db.r.readchanges.insert(rel(db.r.readchanges.header)(
+                *[row(version=version, feedid=feedid,
+                      first=first, last=last, read=True)
+                  for first, last in runs]))
+
+def _log_deletion(feedid):
+    with _changelog_lock:
+        with ns(fid=feedid):
+            db.r.articlechanges.delete('feedid == fid')
+            db.r.readchanges.delete('feedid == fid')
+        db.r.feeddeletions.insert(~row(version=_bump_counter(),
+                                       feedid=feedid))
+
+def _changes_between(low, high):
+    # Return (version, first, kind, row) for the rows logged with a version
+    # in (low, high], in the order they should be applied.
+    with ns(low=low, high=high):
+        window = 'version > low and version <= high'
+        changes = [(x.version, 0, 'deleted', x)
+                   for x in db.r.feeddeletions.where(window)]
+        changes.extend((x.version, x.first, 'added', x)
+                       for x in db.r.articlechanges.where(window))
+        changes.extend((x.version, x.first, 'read', x)
+                       for x in db.r.readchanges.where(window))
+    return sorted(changes, key=operator.itemgetter(0, 1))
+
+def changes_since(since, limit=None):
+    """Return the changes logged after change counter value since.
+
+    The return value is (counter, more, deleted, added, read).  deleted is
+    the list of ids of feeds deleted, which should be applied first: the log
+    entries of a deleted feed are dropped, so everything in added and read
+    refers to the feed currently using the id.  added is the list of
+    articlechanges rows and read the list of readchanges rows, each in
+    version order.  Whole versions are returned until their size reaches
+    limit (default BATCH_SIZE), counting each added article and each other
+    row as one; counter is the last version included, and more is True if
+    there are later changes.
+    """
+    if limit is None:
+        limit = BATCH_SIZE
+    deleted, added, read = [], [], []
+    changes = dict(deleted=deleted, added=added, read=read)
+    count = 0
+    with _changelog_lock:
+        current = counter = change_counter()
+        # Every version logs at least one row, so limit versions at a time
+        # is enough unless rows have been dropped from the log since.
+        while since < current and count < limit:
+            counter = min(since + limit, current)
+            for version, rows in itertools.groupby(
+                    _changes_between(since, counter),
+                    key=operator.itemgetter(0)):
+                if count >= limit:
+                    counter = version - 1
+                    break
+                for _, _, kind, change in rows:
+                    changes[kind].append(change)
+                    if kind == 'added':
+                        count += change.last - change.first + 1
+                    else:
+                        count += 1
+            since = counter
+    return (counter, counter < current, [x.feedid for x in deleted],
+            added, read)
+
+#
+# Export and import
+#
+# The export format is JSON Lines: one JSON object per line, whose 'type' key
+# says what kind of record it is.  Each feed is written as a 'feed' record,
+# followed by its 'article' records in seqno order, its 'pollstats' record,
+# and finally its 'readstate' record.  The article data is written as plain
+# JSON rather than as a pickle, so that it does not depend on the feedparser
+# version.
+#
+# A feed is listed in importing from when import adds it until its readstate
+# record has been applied.  new_articles refuses to add articles to such a
+# feed, since they would take seqnos that the rest of the import needs.
+#
+
+_datetime_format = '%Y-%m-%d %H:%M:%S.%f'
+
+def _init_importing():
+    db['importing'] = rel(feedid=int)
+    db.set_key('importing', {'feedid'})
+
+def _check_schema():
+    if ('read' in db.r.articles.header
+            or any(name not in db for name in ('readstate', 'pollstats',
+                                               'feeddeletions', 'importing'))):
+        raise FeedmeError("Database schema is out of date, "
+                          "run 'upgrade' first")
+
+def export_records():
+    """Return an iterator over the export records for the whole database."""
+    _check_schema()
+    if db.r.importing:
+        raise FeedmeError("Feeds {} are partially imported, run the import "
+                          "again to finish them".format(
+                          sorted(db.r.importing.compute('feedid'))))
+    for feed in db.r.feedlist:
+        with ns(fid=feed.id):
+            published = ~db.r.published.where('id == fid')
+            stats = ~db.r.pollstats.where('feedid == fid')
+        yield dict(type='feed', id=feed.id, url=feed.url, title=feed.title,
+                   subtitle=feed.subtitle,
+                   published=(published.published.strftime(_datetime_format)
+                              if published else None))
+        state = _readstate(feed.id)
+        lastseqno = state.lastseqno
+        for start in range(1, lastseqno + 1, BATCH_SIZE):
+            with ns(fid=feed.id, start=start, end=start+BATCH_SIZE):
+                batch = db.r.articles.where(
+                    'feedid == fid and seqno >= start and seqno < end')
+            for a in sorted(batch, key=operator.attrgetter('seqno')):
+                yield dict(type='article', feedid=a.feedid, seqno=a.seqno,
+                           guid=a.guid, title=a.title, link=a.link,
+                           pubdate=a.pubdate.strftime(_datetime_format),
+                           data=a.data)
+        if stats:
+            yield dict(type='pollstats', feedid=feed.id, digest=stats.digest,
+                       polls=stats.polls, unchanged=stats.unchanged)
+        yield dict(type='readstate', feedid=feed.id,
+                   lastseqno=state.lastseqno, highwater=state.highwater,
+                   flips=sorted(_readflips(feed.id)))
+
+def _article_data(obj):
+    # Rebuild the FeedParserDict from its JSON form.  JSON turns the
+    # *_parsed time.struct_time values into lists, so turn them back.
+    if isinstance(obj, dict):
+        data = {}
+        for k, v in obj.items():
+            if k.endswith('_parsed') and v:
+                data[k] = time.struct_time(v)
+            else:
+                data[k] = _article_data(v)
+        return feedparser.FeedParserDict(data)
+    if isinstance(obj, list):
+        return [_article_data(v) for v in obj]
+    return obj
+
+def import_records(records):
+    """Insert export records into the database, in batches of BATCH_SIZE.
+
+    Feeds already in the database, including those completely imported by an
+    earlier (interrupted) run, are skipped, and a partially imported feed
+    resumes after the last article found in the database.  A feed already in
+    the database with a different URL is an error.  Return the number of
+    feeds and articles added.
+    """
+    _check_schema()
+    feeds = articles = 0
+    batch = []
+    skip = False
+    resume = 0
+    for rec in records:
+        kind = rec['type']
+        if kind != 'article' and batch:
+            db.r.articles.insert(rel(db.r.articles.header)(*batch))
+            batch = []
+        if kind == 'feed':
+            with ns(fid=rec['id']):
+                exists = db.r.feedlist.where('id == fid')
+                importing = db.r.importing.where('feedid == fid')
+                if exists:
+                    if (~exists).url != rec['url']:
+                        raise FeedmeError(
+                            "Feed {} is {} in the database but {} in the "
+                            "import".format(rec['id'], (~exists).url,
+                                            rec['url']))
+                    skip = not importing
+                    if not skip:
+                        ids = db.r.articles.where(
+                            'feedid == fid').compute('seqno')
+                        resume = functools.reduce(max, ids, next(ids, 0))
+                    continue
+                if not importing:
+                    db.r.importing.insert(~row(feedid=rec['id']))
+                skip = False
+                if rec['published'] is None:
+                    published = ~row(id=rec['id'])
+                    if not db.r.published_unknown.where('id == fid'):
+                        db.r.published_unknown.insert(published)
+                elif not db.r.published.where('id == fid'):
+                    pubdate = datetime.strptime(rec['published'],
+                                                _datetime_format)
+                    db.r.published.insert(~row(id=rec['id'],
+                                               published=pubdate))
+            db.r.feedlist.insert(~row(id=rec['id'],
+                                      url=rec['url'],
+                                      title=rec['title'],
+                                      subtitle=rec['subtitle']))
+            resume = 0
+            feeds += 1
+        elif skip:
+            continue
+        elif kind == 'article':
+            if rec['seqno'] <= resume:
+                continue
+            pubdate = datetime.strptime(rec['pubdate'], _datetime_format)
+            batch.append(row(guid=rec['guid'],
+                             feedid=rec['feedid'],
+                             seqno=rec['seqno'],
+                             title=rec['title'],
+                             link=rec['link'],
+                             data=_article_data(rec['data']),
+                             pubdate=pubdate))
+            articles += 1
+            if len(batch) >= BATCH_SIZE:
+                db.r.articles.insert(rel(db.r.articles.header)(*batch))
+                batch = []
+        elif kind == 'pollstats':
+            with ns(fid=rec['feedid']):
+                if not db.r.pollstats.where('feedid == fid'):
+                    db.r.pollstats.insert(~row(feedid=rec['feedid'],
+                                               digest=rec['digest'],
+                                               polls=rec['polls'],
+                                               unchanged=rec['unchanged']))
+        elif kind == 'readstate':
+            # Each step is skipped if an interrupted run already did it.
+            with ns(fid=rec['feedid']):
+                db.r.readflips.delete('feedid == fid')
+                db.r.readflips.insert(rel(db.r.readflips.header)(
+                    *[row(feedid=rec['feedid'], seqno=seqno)
+                      for seqno in rec['flips']]))
+                if not db.r.readstate.where('feedid == fid'):
+                    db.r.readstate.insert(~row(feedid=rec['feedid'],
+                                               lastseqno=rec['lastseqno'],
+                                               highwater=rec['highwater']))
+                if not db.r.articlechanges.where('feedid == fid'):
+                    _log_feed(rec['feedid'], rec['lastseqno'],
+                              rec['highwater'], set(rec['flips']))
+                db.r.importing.delete('feedid == fid')
+        else:
+            raise FeedmeError("Unknown record type {!r}".format(kind))
+    if batch:
+        db.r.articles.insert(rel(db.r.articles.header)(*batch))
+    return feeds, articles
+
 #
 # Commands
 #
 
+def _articles_type():
+    return rel(guid=str,
+               feedid=int,
+               seqno=int,
+               title=str,
+               link=str,
+               data=feedparser.FeedParserDict,
+               pubdate=datetime)
+
 def init(args):
     re = ''
     if args.reinitialize:
@@ -62,15 +596,12 @@ def init(args):
     db['published'] = rel(id=int, published=datetime)
     db.set_key('published', {'id'})
     db['published_unknown'] = rel(id=int)
-    db['articles'] = rel(guid=str,
-                         feedid=int,
-                         seqno=int,
-                         title=str,
-                         link=str,
-                         data=feedparser.FeedParserDict,
-                         pubdate=datetime,
-                         read=bool)
+    db['articles'] = _articles_type()
     db.set_key('articles', {'feedid', 'seqno'})
+    _init_readstate()
+    _init_pollstats()
+    _init_changelog()
+    _init_importing()
     print('Database {}initialized'.format(re))
 
 def wipe(args):
@@ -85,7 +616,8 @@ def addfeed(args):
     ids = db.r.feedlist.compute('id')
     newid = functools.reduce(max, ids, next(ids, 0)) + 1
     try:
-        f = feedparser.parse(args.url)
+        body, headers, digest = fetch_feed(args.url)
+        f = feedparser.parse(body, response_headers=headers)
     except Exception as err:
         print("Unable to read feed {}: {}".format(args.url, err))
         return
@@ -119,6 +651,7 @@ def addfeed(args):
                      )
           )
     new_articles(newid, f)
+    _record_poll(newid, digest, False)
 
 def listfeeds(args):
     p = db.r.published.extend(
@@ -136,6 +669,8 @@ def listarticles(args):
         articles = db.r.articles.where('feedid == wanted')
         if not articles and not db.r.feedlist.where('id == wanted'):
             raise FeedmeError("Unknown feed id {}".format(args.feedid))
+    with ns(unread=unread_seqnos(args.feedid)):
+        articles = articles.extend(rel(read=bool), read='seqno not in unread')
     if args.all:
         cols = ('guid', 'title', 'link', 'pubdate', 'read')
     else:
@@ -147,25 +682,117 @@ def pollfeed(args):
         feed = db.r.feedlist.where("id == wanted")
         if not feed:
             raise FeedmeError("Unknown feed id {}".format(args.feedid))
-    url = (~feed).url
+    feed = ~feed
     try:
-        feedblob = feedparser.parse(url)
+        if not update_feed(args.feedid, feed.url):
+            print(feed.title)
+            print('Feed unchanged')
     except Exception as err:
-        print("Unable to read feed {}: {}".format(url, err))
-        return
-    new_articles(args.feedid, feedblob)
+        print("Unable to read feed {}: {}".format(feed.url, err))
+
+def pollstats(args):
+    stats = db.r.feedlist.rename(id='feedid') & db.r.pollstats
+    cols = ('feedid', 'title', 'polls', 'unchanged')
+    print((stats >> cols).display(*cols, sort=('title')))
 
 def delfeed(args):
     with ns(todel=args.feedid):
         count = len(db.r.articles.where("feedid == todel"))
         title = (~db.r.feedlist.where("id == todel")).title
-        ans = input("Delete {!r} and {} articles? (y/n): ".format(title, count))
-        if ans != 'y':
-            print('aborting')
-            return
-        db.r.articles.delete("feedid == todel")
-        db.r.feedlist.delete("id == todel")
-        print('Done.')
+    ans = input("Delete {!r} and {} articles? (y/n): ".format(title, count))
+    if ans != 'y':
+        print('aborting')
+        return
+    delete_feed(args.feedid)
+    print('Done.')
+
+def markread(args):
+    with ns(wanted=args.feedid):
+        if not db.r.feedlist.where('id == wanted'):
+            raise FeedmeError("Unknown feed id {}".format(args.feedid))
+    mark_feed_read(args.feedid)
+
+def upgrade(args):
+    steps = []
+    if 'pollstats' not in db:
+        steps.append(_init_pollstats)
+    if 'read' in db.r.articles.header:
+        steps.append(_upgrade_readstate)
+    if 'changecounter' not in db:
+        steps.append(_upgrade_changelog)
+    elif 'feeddeletions' not in db:
+        steps.append(_init_feeddeletions)
+    if 'importing' not in db:
+        steps.append(_init_importing)
+    if not steps:
+        print('Database is up to date')
+        return
+    backup = DBPATH + '.bak'
+    shutil.copyfile(DBPATH, backup)
+    print('Database backed up to', backup)
+    for step in steps:
+        step()
+    print('Database upgraded')
+
+def _upgrade_readstate():
+    # Move the read flags out of the article rows into readstate/readflips,
+    # copying the articles without them into a new relation.  The old
+    # articles are only dropped once the copy is complete.
+    _init_readstate()
+    db['articles_upgrade'] = _articles_type()
+    db.set_key('articles_upgrade', {'feedid', 'seqno'})
+    for feed in db.r.feedlist:
+        with ns(fid=feed.id):
+            flags = db.r.articles.where('feedid == fid') >> {'seqno', 'read'}
+        read = {a.seqno for a in flags if a.read}
+        lastseqno = max((a.seqno for a in flags), default=0)
+        highwater = 0
+        while highwater + 1 in read:
+            highwater += 1
+        db.r.readstate.insert(~row(feedid=feed.id,
+                                   lastseqno=lastseqno,
+                                   highwater=highwater))
+        flips = [row(feedid=feed.id, seqno=seqno)
+                 for seqno in read if seqno > highwater]
+        if flips:
+            db.r.readflips.insert(rel(db.r.readflips.header)(*flips))
+        for start in range(1, lastseqno + 1, BATCH_SIZE):
+            with ns(fid=feed.id, start=start, end=start+BATCH_SIZE):
+                batch = db.r.articles.where(
+                    'feedid == fid and seqno >= start and seqno < end')
+            db.r.articles_upgrade.insert(batch << {'read'})
+    del db['articles']
+    db['articles'] = _articles_type()
+    db.set_key('articles', {'feedid', 'seqno'})
+    for state in db.r.readstate:
+        for start in range(1, state.lastseqno + 1, BATCH_SIZE):
+            with ns(fid=state.feedid, start=start, end=start+BATCH_SIZE):
+                db.r.articles.insert(db.r.articles_upgrade.where(
+                    'feedid == fid and seqno >= start and seqno < end'))
+    del db['articles_upgrade']
+
+def _upgrade_changelog():
+    _init_changelog()
+    for state in db.r.readstate:
+        _log_feed(state.feedid, state.lastseqno, state.highwater,
+                  _readflips(state.feedid))
+
+def exportdb(args):
+    _check_schema()
+    feeds = articles = 0
+    with open(args.file, 'w', encoding='utf-8') as f:
+        for rec in export_records():
+            if rec['type'] == 'feed':
+                feeds += 1
+            elif rec['type'] == 'article':
+                articles += 1
+            f.write(json.dumps(rec, ensure_ascii=False) + '\n')
+    print('Exported {} feeds and {} articles'.format(feeds, articles))
+
+def importdb(args):
+    with open(args.file, encoding='utf-8') as f:
+        feeds, articles = import_records(json.loads(line) for line in f)
+    print('Imported {} feeds and {} articles'.format(feeds, articles))
 
 #
 # Command parsing
@@ -206,10 +833,36 @@ def main():
     sub.set_defaults(subfunc=pollfeed)
     sub.add_argument('feedid', type=int, help='id of feed to poll')
 
+    sub = sub_parsers.add_parser('pollstats',
+                                 help='show how often feeds were unchanged')
+    sub.set_defaults(subfunc=pollstats)
+
     sub = sub_parsers.add_parser('delfeed', help='delete a feed')
     sub.set_defaults(subfunc=delfeed)
     sub.add_argument('feedid', type=int, help='id of feed to delete')
 
+    sub = sub_parsers.add_parser('markread',
+                                 help='mark all articles in feed read')
+    sub.set_defaults(subfunc=markread)
+    sub.add_argument('feedid', type=int, help='id of feed to mark read')
+
+    sub = sub_parsers.add_parser('export',
+                                 help='export database as JSON Lines '
+                                      '(run upgrade first on old databases)')
+    sub.set_defaults(subfunc=exportdb)
+    sub.add_argument('file', help='path of file to write')
+
+    sub = sub_parsers.add_parser('import',
+                                 help='import JSON Lines export into an '
+                                      'initialized database')
+    sub.set_defaults(subfunc=importdb)
+    sub.add_argument('file', help='path of file to read')
+
+    sub = sub_parsers.add_parser('upgrade',
+                                 help='upgrade database to current schema '
+                                      '(saving a backup copy first)')
+    sub.set_defaults(subfunc=upgrade)
+
     args = parser.parse_args()
 
     if args.debug:
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 # Copyright (c) 2013 by R. David Murray under an MIT license (LICENSE.txt).
 import os
+import json
 import operator
 import functools
 import contextlib
@@ -9,23 +10,13 @@ import threading
 import time
 from wsgiref import simple_server
 from wsgiref.util import FileWrapper
-from urllib.parse import parse_qs, urlencode
+from urllib.parse import parse_qs
 from util import Trie
-import feedparser
+from layout import page, table, linktable, link
 import syndicalist as syn
 import dinsd
 
 import dinsd.sqlite_pickle_db
-# XXX: Fix this.
-syn.DBPATH = 'webtestdb.sqlite'
-syn.db = dinsd.sqlite_pickle_db.Database(syn.DBPATH)
-#syn.db = dinsd.sqlite_pickle_db.Database(syn.DBPATH, debug_sql=True)
-# Work around the fact that dinsd doesn't persist keys yet.  Having a key on
-# this table is necessary because the feedparser hash function has a bug
-# in it, so we can't depend on it when doing update and delete operations
-# in sqlite (or indexing).
-syn.db.set_key('articles', {'feedid', 'seqno'})
-print(len(syn.db.r.articles), len(syn.db._system_ns.current['_sys_key_articles']))
 
 class NotFound(Exception):
     pass
@@ -37,6 +28,15 @@ def byte_me(iterator):
     for line in iterator:
         yield line.encode('utf-8') + b'\r\n'
 
+def bytes_response(respond, body, content_type='text/html'):
+    respond('200 OK', [('Content-Type', content_type + '; charset=utf-8'),
+                       ('Content-Length', str(len(body)))])
+    return [body]
+
+def json_response(respond, obj):
+    body = json.dumps(obj, separators=(',', ':')).encode('utf-8')
+    return bytes_response(respond, body, 'application/json')
+
 paths = Trie()
 def handles_path(path, args=False):
     def add_path(func):
@@ -52,12 +52,15 @@ def handles_path(path, args=False):
         return handler
     return add_path
 
+def refresh(feedid, url):
+    try:
+        syn.update_feed(feedid, url)
+    except Exception as err:
+        print("Error updating {}: {}".format(url, err))
+
 def refresh_feeds():
     for feed in syn.db.r.feedlist:
-        try:
-            syn.new_articles(feed.id, feedparser.parse(feed.url))
-        except Exception as err:
-            print("Error updating {}: {}".format(feed.url, err))
+        refresh(feed.id, feed.url)
 
 class UpdateThread(threading.Thread):
     def run(self):
@@ -86,8 +89,8 @@ def notfound(environ, respond):
 
 @handles_path('/')
 def feedlist(environ, respond):
-    respond('200 OK', [('Content-Type', 'text/html; charset=utf-8')])
-    yield from byte_me(page('Feedme Feed List', feedlist_content(environ)))
+    return bytes_response(respond,
+                          page('Feedme Feed List', feedlist_content(environ)))
 
 @handles_path('/refresh')
 def refresh_all(environ, respond):
@@ -112,13 +115,14 @@ def articlelist(environ, respond):
     if showall and showall != 'showall':
         raise NotFound('Invalid query string {}'.format(showall))
     feedid, feed = _get_feed_from_args(environ)
-    respond('200 OK', [('Content-Type', 'text/html; charset=utf-8')])
-    return byte_me(page((~feed).title, articlelist_content(feedid, showall)))
+    return bytes_response(respond,
+                          page((~feed).title,
+                               articlelist_content(feedid, showall)))
 
 @handles_path('/feed/refresh/', args=True)
 def refresh_feed(environ, respond):
-    feedid, feed = _get_feed_from_args(environ['PATH_INFO'])
-    syn.new_articles(feedid, feedparser.parse((~feed).url))
+    feedid, feed = _get_feed_from_args(environ)
+    refresh(feedid, (~feed).url)
     raise Redirect('/feed/{}'.format(feedid))
 
 def _get_article_from_args(environ):
@@ -138,15 +142,19 @@ def _get_article_from_args(environ):
 
 def _change_article_read(environ, respond, changefunc, successurl):
     feedid, seqno, _, _ = _get_article_from_args(environ)
-    with dinsd.ns(fid=feedid, sno=seqno, changefunc=changefunc):
-        syn.db.r.articles.update('feedid==fid and seqno==sno',
-                                    read="changefunc(read)")
+    syn.set_read(feedid, seqno, changefunc(syn.is_read(feedid, seqno)))
     raise Redirect(successurl.format(feedid=feedid, seqno=seqno))
 
 @handles_path('/feed/nav/markread/', args=True)
 def feed_mark_article_read(environ, respond):
     _change_article_read(environ, respond, lambda x: True, '/feed/{feedid}')
 
+@handles_path('/feed/nav/markallread/', args=True)
+def feed_mark_all_read(environ, respond):
+    feedid, feed = _get_feed_from_args(environ)
+    syn.mark_feed_read(feedid)
+    raise Redirect('/feed/{}'.format(feedid))
+
 @handles_path('/article/', args=True)
 def article(environ, respond):
     feedid, seqno, feed, article = _get_article_from_args(environ)
@@ -154,11 +162,13 @@ def article(environ, respond):
         content_type = article.data.content[0].type
     else:
         content_type = 'text/html'
-    respond('200 OK', [('Content-Type', content_type + '; charset=utf-8')])
-    return byte_me(page('{}: {}'.format(feed.title, article.title),
-                         article_content(article),
-                         h1=(link(feed.title, '/feed/{}'.format(feedid)) +
-                             ':<br>' + link(article.title, article.link))))
+    h1 = (link(feed.title, '/feed/{}'.format(feedid)) +
+          ':<br>' + link(article.title, article.link))
+    return bytes_response(respond,
+                          page('{}: {}'.format(feed.title, article.title),
+                               article_content(article),
+                               h1=h1),
+                          content_type)
 
 @handles_path('/article/nav/prev/', args=True)
 def article_prev(environ, respond):
@@ -195,6 +205,78 @@ def _article_setread(environ, respond, changefunc):
     _change_article_read(environ, respond, changefunc,
                          '/article/{feedid}/{seqno}')
 
+# JSON API.
+#
+# /api/sync?since=N returns the changes made after change counter value N,
+# for clients that keep their own copy of the articles and read state.  The
+# response gives the counter value to pass as 'since' next time, and 'more'
+# is true if there are further changes waiting.  'deleted' lists the ids of
+# deleted feeds, whose articles the client should drop before applying the
+# rest of the response (the id may since have been reused for a new feed).
+# 'articles' holds the added articles as lists of the fields named by
+# 'article_fields', 'feeds' holds [id, title, url] for their feeds, and
+# 'read' holds [feedid, first, last, read] for each run of articles whose
+# read state was set, in the order the changes should be applied.
+
+ARTICLE_FIELDS = ('feedid', 'seqno', 'guid', 'title', 'link', 'pubdate',
+                  'author', 'content_type', 'content')
+
+def _article_fields(article):
+    data = article.data
+    author = (data.author_detail.get('name', '')
+                if 'author_detail' in data else '')
+    if 'content' in data:
+        content_type = data.content[0].type
+        content = data.content[0].value
+    else:
+        content_type = 'text/html'
+        # RSS items without a description have no summary.
+        content = data.get('summary', '')
+    return [article.feedid, article.seqno, article.guid, article.title,
+            article.link, '{:%Y-%m-%d %H:%M}'.format(article.pubdate),
+            author, content_type, content]
+
+@handles_path('/api/sync')
+def api_sync(environ, respond):
+    settings = parse_qs(environ['QUERY_STRING'])
+    try:
+        since = int(settings.get('since', ['0'])[0])
+    except ValueError as err:
+        raise NotFound('Invalid since value {}'.format(
+                       settings['since'][0])) from err
+    counter, more, deleted, added, read = syn.changes_since(since)
+    articles = []
+    for change in added:
+        with dinsd.ns(fid=change.feedid, first=change.first, last=change.last):
+            batch = syn.db.r.articles.where(
+                'feedid == fid and seqno >= first and seqno <= last')
+        articles.extend(_article_fields(x)
+                        for x in sorted(batch,
+                                        key=operator.attrgetter('seqno')))
+    with dinsd.ns(wanted={x.feedid for x in added}):
+        feeds = syn.db.r.feedlist.where('id in wanted')
+    return json_response(respond, dict(
+        counter=counter,
+        more=more,
+        deleted=deleted,
+        feeds=sorted([x.id, x.title, x.url] for x in feeds),
+        article_fields=ARTICLE_FIELDS,
+        articles=articles,
+        read=[[x.feedid, x.first, x.last, x.read] for x in read]))
+
+@handles_path('/api/markread/', args=True)
+def api_markread(environ, respond):
+    return _api_setread(environ, respond, True)
+
+@handles_path('/api/markunread/', args=True)
+def api_markunread(environ, respond):
+    return _api_setread(environ, respond, False)
+
+def _api_setread(environ, respond, read):
+    feedid, seqno, _, _ = _get_article_from_args(environ)
+    syn.set_read(feedid, seqno, read)
+    return json_response(respond, dict(counter=syn.change_counter()))
+
 @handles_path('/static/', args=True)
 def static(environ, respond):
     fn = environ['PATH_INFO']
@@ -207,71 +289,13 @@ def static(environ, respond):
         return ['not found']
 
 
-# Layout Functions.
-
-def page(title, content, h1=None):
-    if h1 is None:
-        h1 = title
-    yield '<html>'
-    yield '<head>'
-    yield '  <title>'
-    yield '    Feedme: ' + title
-    yield '  </title>'
-    yield '  <meta name="viewport" content="width=device-width">'
-    yield '  <script language="JavaScript" src="/static/swipesense.js"></script>'
-    yield '</head>'
-    yield '<body bgcolor="#000000" text="#FFFFFF" link="#FFFFFF" vlink="#FFFFFF"'
-    yield '      id="body" ontouchstart="touchStart(event, \'body\');"'
-    yield '                ontouchend="touchEnd(event);"'
-    yield '                ontouchmove="touchMove(event);"'
-    yield '                ontouchcancel="touchCancel(event);">'
-    yield '  <h1 style="max-width: 8in">{}</h1>'.format(h1)
-    yield '  <table>'
-    for part in content:
-        yield '    <tr><td>'
-        for line in part:
-            yield '      ' + line
-        yield '    </td></tr>'
-    yield '  </table>'
-    yield '</body>'
-    yield '</html>'
-
-def table(titlerow, content_rows):
-    yield '<table border=1>'
-    yield '  <tr>'
-    for title in titlerow:
-        yield '    <th style="max-width: 8in">{}</th>'.format(title)
-    yield '  </tr>'
-    for row in content_rows:
-        yield '  <tr>'
-        for item in row:
-            yield '    <td style="max-width: 8in">{}</td>'.format(item)
-        yield '  </tr>'
-    yield '</table>'
-
-def linktable(*links):
-    yield '<table width="100%">'
-    yield '  <tr>'
-    yield '    <td align="left">{}</td>'.format(links[0])
-    for link in links[1:-1]:
-        yield '    <td align="center">{}</td>'.format(link)
-    if len(links) > 1:
-        yield '    <td align="right">{}</td>'.format(links[-1])
-    yield '  </tr>'
-    yield '</table>'
-
-def link(text, url, settings=None, style=None):
-    style = ' style="{}" '.format(style) if style else ' '
-    if settings:
-        url = url + '?' + urlencode(settings)
-    return '<a{}href="{}">{}</a>'.format(style, url, text)
+# Content Functions.
 
 def feedlist_content(environ):
     settings = parse_qs(environ['QUERY_STRING'])
     showall = settings.get('showall', False)
-    with dinsd.ns(articles=syn.db.r.articles):
-        feedlist = syn.db.r.feedlist.extend(unread=
-            'len(articles.where("feedid=={} and not read".format(id)))')
+    with dinsd.ns(unread_count=syn.unread_count):
+        feedlist = syn.db.r.feedlist.extend(unread='unread_count(id)')
     selectfunc = (lambda x: True) if showall else (lambda x: x)
     feedlist = [(x.unread, x.title, x.id, x.url)
                 for x in feedlist if selectfunc(x.unread)]
@@ -285,13 +309,14 @@ def feedlist_content(environ):
             '/' + '' if showall else '?showall=1'))
 
 def articlelist_content(feedid, showall):
-    with dinsd.ns(id=feedid):
+    with dinsd.ns(id=feedid, unread=syn.unread_seqnos(feedid)):
         articles = syn.db.r.articles.where(
-            'feedid == id' + ('' if showall else ' and not read'))
+            'feedid == id' + ('' if showall else ' and seqno in unread'))
     yield linktable(
         link('Refresh', '/feed/refresh/{}'.format(feedid)),
         link('Hide Read' if showall else 'Show All',
                   '/feed/{}'.format(feedid) + '' if showall else '?showall'),
+        link('Mark All Read', '/feed/nav/markallread/{}'.format(feedid)),
         link('Feed List', '/'))
     if articles:
             articles = [(x.title, x.seqno, x.pubdate,
@@ -311,12 +336,13 @@ def articlelist_content(feedid, showall):
         link('Refresh', '/feed/refresh/{}'.format(feedid)),
         link('Hide Read' if showall else 'Show All',
                   '/feed/{}'.format(feedid) + '' if showall else '?showall'),
+        link('Mark All Read', '/feed/nav/markallread/{}'.format(feedid)),
         link('Feed List', '/'))
 
 def article_content(article):
     feedid = article.feedid
     seqno = article.seqno
-    readstate = 'Mark Unread' if article.read else 'Mark Read'
+    readstate = 'Mark Unread' if syn.is_read(feedid, seqno) else 'Mark Read'
     aid = str(feedid) + '/' + str(seqno)
     yield article_body(article)
     yield linktable(
@@ -325,9 +351,7 @@ def article_content(article):
         link('Next', '/article/nav/next/' + aid))
 
 def article_body(article):
-    with dinsd.ns(fid=article.feedid):
-        unreadcount = len(syn.db.r.articles.where('feedid==fid and not read'))
-    unreadlabel = '({} unread)'.format(unreadcount)
+    unreadlabel = '({} unread)'.format(syn.unread_count(article.feedid))
     yield '<div style="max-width:8in">'
     # XXX: Do 'today' and 'yesterday' and weekdays
     if 'author_detail' in article.data and 'name' in article.data.author_detail:
@@ -349,10 +373,22 @@ def article_body(article):
     yield '</div>'
 
 
-syn_server = simple_server.make_server('', 8080, app)
-try:
-    update_thread = UpdateThread(daemon=True)
-    update_thread.start()
-    syn_server.serve_forever()
-except KeyboardInterrupt:
-    syn.db.close()
+if __name__ == '__main__':
+    # XXX: Fix this.
+    syn.DBPATH = 'webtestdb.sqlite'
+    syn.db = dinsd.sqlite_pickle_db.Database(syn.DBPATH)
+    #syn.db = dinsd.sqlite_pickle_db.Database(syn.DBPATH, debug_sql=True)
+    # Work around the fact that dinsd doesn't persist keys yet.  Having a key
+    # on this table is necessary because the feedparser hash function has a
+    # bug in it, so we can't depend on it when doing update and delete
+    # operations in sqlite (or indexing).
+    syn.db.set_key('articles', {'feedid', 'seqno'})
+    print(len(syn.db.r.articles),
+          len(syn.db._system_ns.current['_sys_key_articles']))
+    syn_server = simple_server.make_server('', 8080, app)
+    try:
+        update_thread = UpdateThread(daemon=True)
+        update_thread.start()
+        syn_server.serve_forever()
+    except KeyboardInterrupt:
+        syn.db.close()
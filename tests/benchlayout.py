@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# Copyright (c) 2013 by R. David Murray under an MIT license (LICENSE.txt).
+"""Microbenchmark for layout.page.
+
+Compares page() against the old rendering, which yielded the page a line at a
+time and encoded each line separately (the way syndicalistwebui.byte_me did),
+and checks that the two produce byte-for-byte identical output.  The time to
+render the page and the time for a wsgiref handler to write the resulting
+chunks are reported separately.
+
+Run from the tests directory:  python3 benchlayout.py [rows]
+"""
+import io
+import os
+import sys
+import timeit
+from wsgiref.handlers import SimpleHandler
+from wsgiref.util import setup_testing_defaults
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+from layout import page, table, linktable, link
+
+
+def old_page(title, content, h1=None):
+    if h1 is None:
+        h1 = title
+    yield '<html>'
+    yield '<head>'
+    yield '  <title>'
+    yield '    Feedme: ' + title
+    yield '  </title>'
+    yield '  <meta name="viewport" content="width=device-width">'
+    yield '  <script language="JavaScript" src="/static/swipesense.js"></script>'
+    yield '</head>'
+    yield '<body bgcolor="#000000" text="#FFFFFF" link="#FFFFFF" vlink="#FFFFFF"'
+    yield '      id="body" ontouchstart="touchStart(event, \'body\');"'
+    yield '                ontouchend="touchEnd(event);"'
+    yield '                ontouchmove="touchMove(event);"'
+    yield '                ontouchcancel="touchCancel(event);">'
+    yield '  <h1 style="max-width: 8in">{}</h1>'.format(h1)
+    yield '  <table>'
+    for part in content:
+        yield '    <tr><td>'
+        for line in part:
+            yield '      ' + line
+        yield '    </td></tr>'
+    yield '  </table>'
+    yield '</body>'
+    yield '</html>'
+
+def byte_me(iterator):
+    for line in iterator:
+        yield line.encode('utf-8') + b'\r\n'
+
+
+def articlelist_content(rows):
+    articles = [(link('Article title número {}'.format(n),
+                      '/article/nav/markread/1/{}'.format(n)),
+                 'Some Author',
+                 '2013-08-01 12:{:02}'.format(n % 60),
+                 link('X', '/feed/nav/markread/1/{}'.format(n)))
+                for n in range(rows)]
+    links = (link('Refresh', '/feed/refresh/1'),
+             link('Show All', '/feed/1?showall'),
+             link('Feed List', '/'))
+    yield linktable(*links)
+    yield table(('Title', 'Author', 'Published', ''), articles)
+    yield linktable(*links)
+
+def render_old(content):
+    return list(byte_me(old_page('Sample Feed', content)))
+
+def render_new(content):
+    return [page('Sample Feed', content)]
+
+
+def serve(chunks):
+    # Run a wsgiref handler over an app returning chunks, the way
+    # simple_server does, minus the socket.
+    def app(environ, respond):
+        respond('200 OK', [('Content-Type', 'text/html; charset=utf-8')])
+        return chunks
+    environ = {}
+    setup_testing_defaults(environ)
+    handler = SimpleHandler(io.BytesIO(), io.BytesIO(), sys.stderr, environ)
+    handler.run(app)
+
+
+def best_usec(func, number=200):
+    return min(timeit.repeat(func, number=number, repeat=5)) / number * 1e6
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    # The content lines are the same for both renderings, so generate them
+    # once rather than timing link() and format() along with the rendering.
+    content = [list(part) for part in articlelist_content(rows)]
+    old = render_old(content)
+    new = render_new(content)
+    if b''.join(old) != b''.join(new):
+        sys.exit('output mismatch')
+    print('{} rows, {} bytes: {} chunks before, {} after'.format(
+          rows, len(new[0]), len(old), len(new)))
+    print('{:15} {:>8} {:>8} {:>8}'.format('usec/page', 'render', 'write',
+                                          'total'))
+    for name, func in (('line at a time', render_old),
+                       ('page template', render_new)):
+        chunks = func(content)
+        render = best_usec(lambda: func(content))
+        write = best_usec(lambda: serve(chunks))
+        print('{:15} {:8.1f} {:8.1f} {:8.1f}'.format(name, render, write,
+                                                    render + write))
+
+
+if __name__ == '__main__':
+    main()
@@ -167,3 +167,38 @@ class Trie:
         if node[1]:
             return node[1], key[index:]
         return
+
+
+class Template:
+
+    """A text template whose static fragments are encoded only once.
+
+    The source string is split on '{}' placeholders, and the static fragments
+    between them are encoded when the template is created.  render() encodes
+    the dynamic values and joins everything into a single bytes buffer.  No
+    other format syntax is recognized, so the values (and the rest of the
+    source) may contain braces freely.
+
+        >>> t = Template('<p>{}</p>{}\\r\\n')
+        >>> t.render('a {b}', 'é')
+        b'<p>a {b}</p>\\xc3\\xa9\\r\\n'
+        >>> t.render('a')
+        Traceback (most recent call last):
+          ...
+        TypeError: template takes 2 values, got 1
+
+    """
+
+    def __init__(self, source, encoding='utf-8'):
+        self.encoding = encoding
+        self.fragments = [x.encode(encoding) for x in source.split('{}')]
+
+    def render(self, *values):
+        if len(values) != len(self.fragments) - 1:
+            raise TypeError("template takes {} values, got {}".format(
+                            len(self.fragments) - 1, len(values)))
+        parts = [self.fragments[0]]
+        for value, fragment in zip(values, self.fragments[1:]):
+            parts.append(value.encode(self.encoding))
+            parts.append(fragment)
+        return b''.join(parts)